@@ -3,11 +3,20 @@
 import sys
 import argparse
 import yaml
+import json
 import os.path
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from PIL import Image, ImageDraw, ImageFont
+import numpy as np
 import math
-import re
+
+# use the libyaml bindings when available, they are considerably faster than the pure python implementation
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
 
 def fatalError(message):
     print(f'ERROR: {message}')
@@ -23,8 +32,33 @@ parser.add_argument('-p', '--play', action='store_true', help='generate yaml fil
 
 args = parser.parse_args()
 
-with open(args.template) as f:
-    game = yaml.load(f, Loader=yaml.FullLoader)
+# The parsed template is cached in a json file next to it, json is much faster to load than yaml
+templateCache = args.template + '.jsoncache'
+game = None
+if os.path.isfile(templateCache) and os.path.getmtime(templateCache) >= os.path.getmtime(args.template):
+    try:
+        with open(templateCache) as f:
+            game = json.load(f)
+    except ValueError:
+        # broken cache file, parse the template again
+        pass
+if game is None:
+    with open(args.template) as f:
+        game = yaml.load(f, Loader=SafeLoader)
+    # Only cache templates that json reproduces exactly (json cannot store e.g. dates, and turns int or bool keys into strings)
+    try:
+        data = json.dumps(game)
+        cacheable = json.loads(data) == game
+    except (TypeError, ValueError):
+        cacheable = False
+    if cacheable:
+        # replace the cache file at once, to never leave a partially written cache behind
+        try:
+            with open(templateCache + '.tmp', 'w') as f:
+                f.write(data)
+            os.replace(templateCache + '.tmp', templateCache)
+        except OSError:
+            print(f'WARNING: Could not write cache file {templateCache}.')
 
 if not type(game) is dict:
     print('ERROR: Invalid input file.')
@@ -50,9 +84,10 @@ pixelSize = game['memory'].get('pixelSize', 2)
 # DPI of generated OIDs
 dpi = game['memory'].get('dpi', 1200)
 # The output yaml file
-outputFile = game['memory'].get('outputFile', args.template.replace('.yaml', '-generated.yaml'))
+templateStem = os.path.splitext(args.template)[0]
+outputFile = game['memory'].get('outputFile', f'{templateStem}-generated.yaml')
 # The output image file
-outputImage = game['memory'].get('outputImage', args.template.replace('.yaml', f'-{dpi}dpi-{pixelSize}mm.png'))
+outputImage = game['memory'].get('outputImage', f'{templateStem}-{dpi}dpi-{pixelSize}mm.png')
 # Get the language prefix for instruction sound files
 lang = game.get('language', 'en')
 # Get the title
@@ -76,7 +111,16 @@ if outputImage == args.template:
 oidCacheDir = 'oid-cache'
 
 # initialization: lay out the cards in order, and set the number of pairs to find
-game['init'] = ' '.join([f'$c{x}:={x+1}' for x in range(numCards)]) + f' $remaining:={numPairs} $player:=1'
+init = {f'c{x}': x+1 for x in range(numCards)}
+init['remaining'] = numPairs
+init['player'] = 1
+game['init'] = ' '.join([f'${v}:={value}' for v, value in init.items()])
+
+# All variables and their initial value (needed to restart the game): every variable used in a script must be declared
+variables = dict(init)
+def declare(*names):
+    for v in names:
+        variables.setdefault(v, 0)
 
 # return the sound name for the given card
 def sound(card):
@@ -90,6 +134,19 @@ def sound(card):
             return f'{p}_b'
     return p
 
+# the sound names of all cards, sounds[c-1] is the sound of card c
+sounds = [sound(c) for c in range(1, numCards+1)]
+
+# Jump to the given script and play the given sound
+# The TipToi pen has a delay when a line ends with a J() command, which does not occur if the J() is followed by a P() (a P(nop) if there is nothing to play).
+# In play mode the sound is played before the jump and P(nop) is left out: "tttool play" currently executes only the last P(m) if there are multiple J(m) P(m) in succession.
+def jump(script, audio='nop'):
+    if not args.play:
+        return f'J({script}) P({audio})'
+    if audio == 'nop':
+        return f'J({script})'
+    return f'P({audio}) J({script})'
+
 scripts = {}
 
 # $busy register is used to prevent the user to take an action while some script is still executing
@@ -98,61 +155,82 @@ scripts['idle'] = '$busy:=0'
 
 # Player fields:
 for p in range(1, players+1):
+    declare('players', 'random', f'pairs{p}')
     scripts[f'p{p}'] = [
         # Choose number of players at the beginning of the game & initialize $random
-        f'$players==0? $players:={p} $busy:=1 T($random, 65535) J(shuffle) P({lang}_shuffle)',
+        f'$players==0? $players:={p} $busy:=1 T($random, 65535) {jump("shuffle", f"{lang}_shuffle")}',
         # Remind that this player is not playing
-        f'$busy==0? $players<{p}? $busy:=1 J(idle) P({lang}_not_playing)'
+        f'$busy==0? $players<{p}? $busy:=1 {jump("idle", f"{lang}_not_playing")}'
         # Speak out the number of pairs of the given player during the game (and when its finished)
-        ] + [f'$busy==0? $pairs{p}=={pa}? $busy:=1 J(idle) P({lang}_pairs{pa})' for pa in range(numPairs+1)]
+        ] + [f'$busy==0? $pairs{p}=={pa}? $busy:=1 {jump("idle", f"{lang}_pairs{pa}")}' for pa in range(numPairs+1)]
 
 # Question mark field:
 # Check game started
-question = [f'$busy==0? $players==0? $busy:=1 J(idle) P({lang}_not_started)']
+question = [f'$busy==0? $players==0? $busy:=1 {jump("idle", f"{lang}_not_started")}']
 # Tell which players turn it is (if the game is still ongoing)
-question += [f'$busy==0? $remaining>0? $player=={p}? $busy:=1 J(idle) P({lang}_player{p})' for p in range(1, players+1)]
+question += [f'$busy==0? $remaining>0? $player=={p}? $busy:=1 {jump("idle", f"{lang}_player{p}")}' for p in range(1, players+1)]
 # Tell who is the winner
 for player in range(1, players+1):
     compare = '$busy==0? '
     for other in range(1, players+1):
         if player != other:
             compare += f'$pairs{player}>$pairs{other}? '
-    question.append(compare + f'$busy:=1 J(idle) P({lang}_winner{player})')
+    question.append(compare + f'$busy:=1 {jump("idle", f"{lang}_winner{player}")}')
 # Else: there are multiple winners
-question.append(f'$busy==0? $busy:=1 J(idle) P({lang}_draw)')
+question.append(f'$busy==0? $busy:=1 {jump("idle", f"{lang}_draw")}')
 scripts['q'] = question
 
 # Restart game if finished, else repeat last card again: This can be useful if there was some noise and the card wasn't heard by someone.
 # But it won't help if in addition all players forgot which card has been tipped :-)
 # (The coordinates of the last card could be read out in addition, but that just get's too complicated.)
-scripts['r'] = [f'$busy==0? $remaining==0? $busy:=1 J(restart0) P(nop)'] + [f'$busy==0? $lastCard=={c}? $busy:=1 J(idle) P({sound(c)})' for c in range(1, numCards+1)]
+declare('lastCard')
+scripts['r'] = [f'$busy==0? $remaining==0? $busy:=1 {jump("restart0")}'] + [f'$busy==0? $lastCard=={c}? $busy:=1 {jump("idle", s)}' for c, s in enumerate(sounds, 1)]
 
 # Shuffle the cards
+# $pos (where the card shall be moved) is drawn from the high bits of the 16 bit random number $rnd by multiply-shift range reduction:
+# $pos = $rnd * range / 65536, which is computed as $pos = $rnd / ceil(65536 / range) because the TipToi has no 32 bit multiplication.
+# The low bits left over, $rnd*=range, are again evenly distributed and are used for the draw of the next step, so that a single random
+# number serves several steps. A new random number is only generated once the product of the drawn ranges exceeds rndBudget.
+rndBudget = 8192
+declare('random', 'rnd', 'pos', 't')
+newRandom = '$random*=25173 $random+=13849 $rnd:=$random'
+def drawPos(n):
+    return f'$pos:=$rnd $pos/={-(-65536 // n)} $rnd*={n}'
+
 # Start by computing $pos where the 1st card shall be moved
-scripts['shuffle'] = f'$random*=25173 $random+=13849 $rnd:=$random $pos:=$rnd $pos%={numCards} $rnd/={numCards} J(shuffle0) P(nop)'
+scripts['shuffle'] = f'{newRandom} {drawPos(numCards)} {jump("shuffle0")}'
+rndUsed = numCards
+# Card variable names, and the tail of the last shuffle step that starts the game
+cardVars = [f'$c{pos}' for pos in range(numCards)]
+startTail = f'P({lang}_start) {jump("idle", f"{lang}_player1")}'
 # The first loop iterates over all positions
 for pos1 in range(numCards-1):
-    l = []
+    l = scripts[f'shuffle{pos1}'] = []
     if pos1 < numCards-2:
-        # Special case: when $rnd becomes too small, generate a new random number and repeat this script
-        # (this must be done in a separate step to not end up with more than 8 commands per line; for the same reason $rnd is used multiple times; but it can be skipped in the last step)
-        l.append(f'$rnd<{10 * (numCards-pos1-1)}? $random*=25173 $random+=13849 $rnd:=$random J(shuffle{pos1}) P(nop)')
+        # Compute pos where to move the next card and jump to the next shuffle step
+        nextRange = numCards-pos1-1
+        if rndUsed * nextRange <= rndBudget:
+            rndUsed *= nextRange
+            tail = f'{drawPos(nextRange)} {jump(f"shuffle{pos1+1}")}'
+        else:
+            # $rnd is used up: generate a new random number in a separate script (to not end up with more than 8 commands per line)
+            rndUsed = nextRange
+            scripts[f'shuffle{pos1+1}rnd'] = f'{newRandom} {drawPos(nextRange)} {jump(f"shuffle{pos1+1}")}'
+            tail = jump(f'shuffle{pos1+1}rnd')
+    else: # pos1 == numCards-2 because shuffle of the last card (numCards-1) is skipped because there is no other position available for that card
+        # After last shuffle start the game
+        tail = startTail
+    c1 = cardVars[pos1]
 
     # The second loop iterates over the current field to the end, to chose to which place the current card shall be moved.
-    for pos2 in range(pos1, numCards):
-        swap = f'$pos=={pos2-pos1}? '
-        if pos1 != pos2: # swap cards on pos1 and pos2
-            swap += f'$t:=$c{pos1} $c{pos1}:=$c{pos2} $c{pos2}:=$t '
-        if pos1 == numCards-2: # -2 because shuffle of the last card (numCards-1) is skipped because there is no other position available for that card
-            # After last shuffle start the game
-            swap += f'P({lang}_start) J(idle) P({lang}_player1)'
-        else:
-            # Compute pos where to move the next card and jump to the next shuffle step
-            swap += f'$pos:=$rnd $pos%={numCards-pos1-1} $rnd/={numCards-pos1-1} J(shuffle{pos1+1}) P(nop)'
-        l.append(swap)
-    scripts[f'shuffle{pos1}'] = l
+    # The current card stays in place for $pos==0, else the cards on pos1 and pos2 are swapped
+    l.append(f'$pos==0? {tail}')
+    for pos2 in range(pos1+1, numCards):
+        c2 = cardVars[pos2]
+        l.append(''.join([f'$pos=={pos2-pos1}? $t:=', c1, ' ', c1, ':=', c2, ' ', c2, ':=$t ', tail]))
 
 # The cards:
+declare('card1', 'pos1', 'lastPos', 'card2', 'pos2')
 for c in range(numCards):
     scripts['c{}'.format(c)] = [
         # Game is not yet started
@@ -160,83 +238,64 @@ for c in range(numCards):
         # Game is already finished
         f'$remaining==0? P({lang}_finished)',
         # Chosen field is already empty - something that cannot happen in the real memory :-): be nice and let the player chose another field
-        f'$busy==0? $c{c}==0? $busy:=1 J(idle) P({lang}_empty)',
+        f'$busy==0? $c{c}==0? $busy:=1 {jump("idle", f"{lang}_empty")}',
         # Player choses a 1st card ($busy must be checked to make sure the player cannot re-chose another 1st card while the 2nd card is being processed)
-        f'$busy==0? $card1==0? $card1:=$c{c} $pos1:={c} $lastCard:=$c{c} $lastPos:={c} $busy:=1 J(firstCard) P(nop)',
+        f'$busy==0? $card1==0? $card1:=$c{c} $pos1:={c} $lastCard:=$c{c} $lastPos:={c} $busy:=1 {jump("firstCard")}',
         # Player tips agan on the 1st card, replay its sound
-        f'$busy==0? $card1==$c{c}? $busy:=1 J(firstCard) P(nop)',
+        f'$busy==0? $card1==$c{c}? $busy:=1 {jump("firstCard")}',
         # Player choses a 2nd card ($busy is checked and set to make sure the player cannot re-chose another 2nd card while the card is being read out)
-        f'$busy==0? $card1!=$c{c}? $card2:=$c{c} $pos2:={c} $lastCard:=$c{c} $lastPos:={c} $busy:=1 J(secondCard) P(nop)'
+        f'$busy==0? $card1!=$c{c}? $card2:=$c{c} $pos2:={c} $lastCard:=$c{c} $lastPos:={c} $busy:=1 {jump("secondCard")}'
     ]
 
 # Read out first card
-scripts['firstCard'] = [f'$card1=={c}? J(idle) P({sound(c)})' for c in range(1, numCards+1)]
+scripts['firstCard'] = [f'$card1=={c}? {jump("idle", s)}' for c, s in enumerate(sounds, 1)]
 
 # Read out second card & test for a match
-scripts['secondCard'] = [f'$card2=={c}? $sum:=$card1 $sum+=$card2 $card1:=0 $card2:=0 J(test) P({sound(c)})' for c in range(1, numCards+1)]
+declare('sum')
+scripts['secondCard'] = [f'$card2=={c}? $sum:=$card1 $sum+=$card2 $card1:=0 $card2:=0 {jump("test", s)}' for c, s in enumerate(sounds, 1)]
 
 # Test for matching cards: increase pairs of current player or move to next player
-scripts['test'] = [f'$sum=={numCards+1}? $player=={p}? $pairs{p}+=1 $remaining-=1 J(clear1) P({lang}_match)' for p in range(1, players+1)] \
-    + [f'$player==$players? $player:=1 J(idle) P({lang}_player1)'] + [f'$player=={p}? $player+=1 J(idle) P({lang}_player{p+1})' for p in range(1, players)]
+scripts['test'] = [f'$sum=={numCards+1}? $player=={p}? $pairs{p}+=1 $remaining-=1 {jump("clear1", f"{lang}_match")}' for p in range(1, players+1)] \
+    + [f'$player==$players? $player:=1 {jump("idle", f"{lang}_player1")}'] + [f'$player=={p}? $player+=1 {jump("idle", f"{lang}_player{p+1}")}' for p in range(1, players)]
 
 # Check end of game condition, else remove the two cards (the last two cards are never removed from the board to save some jumps, but this does not matter)
-scripts['clear1'] = [f'$remaining==0? $busy:=0 J(q) P({lang}_finished)'] + [f'$pos1=={c}? $c{c}:=0 $pos1:=0 J(clear2) P(nop)' for c in range(numCards)]
-scripts['clear2'] = [f'$pos2=={c}? $c{c}:=0 $pos2:=0 J(idle) P({lang}_continue)' for c in range(numCards)]
+continueJump = jump('idle', f'{lang}_continue')
+scripts['clear1'] = [f'$remaining==0? $busy:=0 {jump("q", f"{lang}_finished")}'] + [f'$pos1=={c}? {v}:=0 $pos1:=0 {jump("clear2")}' for c, v in enumerate(cardVars)]
+scripts['clear2'] = [f'$pos2=={c}? {v}:=0 $pos2:=0 {continueJump}' for c, v in enumerate(cardVars)]
 
 # Restart the game:
-# Find all variables and their initial value
-regex = re.compile(r'\$([a-zA-Z0-9]+):=([0-9]+)')
-variables = {}
-for a in regex.findall(game['init']):
-    variables[a[0]] = a[1]
-regex = re.compile(r'\$([a-zA-Z0-9]+)')
-for script in scripts.values():
-    for line in script:
-        for o in regex.findall(line):
-            if not o in variables:
-                variables[o] = 0
-# $busy is cleared separatly through J(idle) at the end
-del variables['busy']
-
-# Produce a list of scripts to reset the variables (to not have more than 8 commands)
-count = 0
-cmd = ''
-i = 0
-for variable in variables.items():
-    if count == 6:
-        scripts[f'restart{i}'] = cmd + f'J(restart{i+1}) P(nop)'
-        i += 1
-        count = 0
-        cmd = ''
-    count += 1
-    cmd += f'${variable[0]}:={variable[1]} '
-scripts[f'restart{i}'] = cmd + f'J(idle) P({game["welcome"]})'
+# $busy is not part of the variables because it is cleared separatly through J(idle) at the end
+
+# Produce a list of scripts to reset the variables (to not have more than 8 commands), the last one plays the welcome sound if there is one
+assignments = [f'${v}:={value} ' for v, value in variables.items()]
+restarts = [assignments[i:i+6] for i in range(0, len(assignments), 6)]
+welcome = game.get('welcome', 'nop')
+for i, restart in enumerate(restarts):
+    tail = jump(f'restart{i+1}') if i < len(restarts)-1 else jump('idle', welcome)
+    scripts[f'restart{i}'] = ''.join(restart) + tail
 
 game['scripts'] = scripts
 
 # Generate speak entries for the cards in case there are none already present
-speak = game.get('speak', [])
+speak = game.get('speak', {})
 for p in pairs:
     if alternativeSounds:
-        if not f'{p}_a' in speak:
-            speak[f'{p}_a'] = p
-        if not f'{p}_b' in speak:
-            speak[f'{p}_b'] = p
+        speak.setdefault(f'{p}_a', p)
+        speak.setdefault(f'{p}_b', p)
     else:
-        if not p in speak:
-            speak[p] = p
+        speak.setdefault(p, p)
 
 # Remove all speak entries that already have an audio file
 mediaPath = game.get('media-path', 'media/%s')
-for s in list(game['speak']):
+for s in list(speak):
     for ext in ['.wav', '.ogg', '.flac', '.mp3']:
         audioFile = mediaPath.replace('%s', s + ext)
         if os.path.isfile(audioFile):
-            del game['speak'][s]
+            del speak[s]
             break
 if len(speak) == 0:
     # Remove speak when there are no missing audio files
-    del game['speak']
+    game.pop('speak', None)
 else:
     game['speak'] = speak
     print(f'{len(speak)} audio files are missing: {", ".join(speak)}')
@@ -248,48 +307,31 @@ if 'scriptcodes' in game:
 
 # Question, Repeat & Player fields
 code = 2000
-if not 'q' in codes:
-    codes['q'] = code
+codes.setdefault('q', code)
 code += 1
-if not 'r' in codes:
-    codes['r'] = code
+codes.setdefault('r', code)
 for p in range(players):
     code += 1
-    script = f'p{p+1}'
-    if not script in codes:
-        codes[script] = code
+    codes.setdefault(f'p{p+1}', code)
 
 # Cards
 code = 3000
 for c in range(numCards):
-    script = f'c{c}'
-    if not script in codes:
-        codes[script] = code
+    codes.setdefault(f'c{c}', code)
     code += 1
 
 # Add all other scripts
 code = 4000
 for script in scripts:
-    if not script in codes:
-        codes[script] = code
+    # only advance the code if it was taken by this script
+    if codes.setdefault(script, code) == code:
         code += 1
 
 game['scriptcodes'] = codes
 
 
-if args.play:
-    # Remove P(nop) commands and flip any J(m) P(m) into P(m) J(m)
-    # This makes the yaml file suitable for the "tttool play" that currently executes only the last P(m) if there are multiple J(m) P(m) in succession
-    nop = re.compile(r' P\(nop\)')
-    jump = re.compile(r'(J\([^\)]+\)) (P\([^\)]+\))')
-    for s in scripts:
-        if type(scripts[s]) == list:
-            scripts[s] = [jump.sub(r'\2 \1', nop.sub('', l)) for l in scripts[s]]
-        else:
-            scripts[s] = jump.sub(r'\2 \1', nop.sub('', scripts[s]))
-
 with open(outputFile, 'w') as f:
-    data = yaml.dump(game, f, allow_unicode=True, width=1000)
+    yaml.dump(game, f, Dumper=SafeDumper, allow_unicode=True, width=1000, sort_keys=False)
 print(f"Generated file: {outputFile}")
 
 def check_tttool():
@@ -302,140 +344,202 @@ if args.play:
     sys.exit(0)
 else:
     check_tttool()
-    subprocess.run([tttool, "assemble", outputFile], check=True)
-    print(f"Generated file: {outputFile.replace('.yaml', '.gme')}")
+    # Assemble the gme file in the background while the game board is produced
+    assemble = subprocess.Popen([tttool, "assemble", outputFile], stdout=subprocess.DEVNULL)
 
-if args.yml_only:
-    sys.exit(0)
-
-# Produce Game Board
-def mm2px(mm):
-    return int(mm * dpi / 25.4)
-
-margin = dpi/6
-width = mm2px(imgWidth)
-height = mm2px(imgHeight)
-
-yTitle = mm2px(10)
-ySubtitle = yTitle + mm2px(10)
-yHeader = ySubtitle + mm2px(10)
-yCards = yHeader + mm2px(30)
-
-# determine circle size to fit players + 3 cricles in a row on the page
-circleSize = min(mm2px(25), int(width / (players + 3) * 0.95))
-
-w = width
-h = height - yCards
-
-rows = 0
-cols = 0
-size = 0
-# Search for the card layout that allows for the largest cards:
-for c in range(1, numCards+1):
-    r = math.ceil(numCards / c)
-    # chose size by filling horizontally
-    s = int((w - (c-1) * margin) / c)
-    # check if it fits & is better
-    if r * s + (r-1) * margin <= h and s >= size:
-        size = s
-        rows = r
-        cols = c
-    # chose size by filling vertically
-    s = int((h - (r-1) * margin) / r)
-    # check if it fits & is better
-    if c * s + (c-1) * margin <= w and s >= size:
-        size = s
-        rows = r
-        cols = c
-
-# maxCardSize in pixels:
-maxSize = int(maxCardSize * dpi / 25.4)
-if size > maxSize:
-    size = maxSize
-
-# create cache dir for OID png files
-if not os.path.exists(oidCacheDir):
-    os.mkdir(oidCacheDir)
-elif not os.path.isdir(oidCacheDir):
-    print(f'ERROR: "{oidCacheDir}" is not a directory')
-    sys.exit(1)
+def waitForAssemble():
+    # wait for tttool and report the result, returns False if the gme file could not be assembled
+    if assemble.wait() != 0:
+        print(f'ERROR: tttool failed to assemble {outputFile}.')
+        return False
+    print(f"Generated file: {os.path.splitext(outputFile)[0]}.gme")
+    return True
 
-img = Image.new('RGBA', (width, height), 'white')
-draw = ImageDraw.Draw(img)
-
-def centerText(x, y, msg, font, color):
-    w, h = draw.textsize(msg, font=font)
-    w2, h2 = font.getoffset(msg) # todo: is this a bug or really needed? Seems to depend on the font
-    w += w2
-    h += h2
-    draw.text((x-w/2, y-h/2), msg, fill=color, font=font)
-
-def drawOid(oid, x, y, size, round=True):
-    # check if OID file already exists
-    path = f'{oidCacheDir}/oid-{oid}-{dpi}dpi-{pixelSize}px.png'
-    if not os.path.isfile(path):
-        # generated OID file
+if args.yml_only:
+    sys.exit(0 if waitForAssemble() else 1)
+
+try:
+    # Produce Game Board
+    def mm2px(mm):
+        return int(mm * dpi / 25.4)
+
+    margin = dpi/6
+    width = mm2px(imgWidth)
+    height = mm2px(imgHeight)
+
+    yTitle = mm2px(10)
+    ySubtitle = yTitle + mm2px(10)
+    yHeader = ySubtitle + mm2px(10)
+    yCards = yHeader + mm2px(30)
+
+    # determine circle size to fit players + 3 cricles in a row on the page
+    circleSize = min(mm2px(25), int(width / (players + 3) * 0.95))
+
+    w = width
+    h = height - yCards
+
+    rows = 0
+    cols = 0
+    size = 0
+    # Search for the card layout that allows for the largest cards:
+    for c in range(1, numCards+1):
+        r = math.ceil(numCards / c)
+        # chose size by filling horizontally
+        s = int((w - (c-1) * margin) / c)
+        # check if it fits & is better
+        if r * s + (r-1) * margin <= h and s >= size:
+            size = s
+            rows = r
+            cols = c
+        # chose size by filling vertically
+        s = int((h - (r-1) * margin) / r)
+        # check if it fits & is better
+        if c * s + (c-1) * margin <= w and s >= size:
+            size = s
+            rows = r
+            cols = c
+
+    # maxCardSize in pixels:
+    maxSize = int(maxCardSize * dpi / 25.4)
+    if size > maxSize:
+        size = maxSize
+
+    # create cache dir for OID png files
+    if not os.path.exists(oidCacheDir):
+        os.mkdir(oidCacheDir)
+    elif not os.path.isdir(oidCacheDir):
+        print(f'ERROR: "{oidCacheDir}" is not a directory')
+        sys.exit(1)
+
+    def oidPath(oid):
+        return f'{oidCacheDir}/oid-{oid}-{dpi}dpi-{pixelSize}px.png'
+
+    def generateOid(oid):
+        # generate OID file and move it to the cache
         subprocess.run([tttool, "--code-dim", str(maxCardSize), '--pixel-size', str(pixelSize), '--dpi', str(dpi), "oid-code", str(oid)], check=True)
-        os.rename(f'./oid-{oid}.png', path)
-    # open and draw the image
-    oidImg = Image.open(path).crop((0, 0, size+1, size+1)).convert("RGBA")
-    if round:
-        # Create a round alpha channel to keep only a circle
-        alpha = oidImg.getchannel('A')
-        black = Image.new('L', (size+1, size+1), color='black')
-        circle = Image.new('L', (size+1, size+1), color='white')
-        ImageDraw.Draw(circle).ellipse([0, 0, size+1, size+1], fill='black')
-        alpha.paste(black, (0,0), circle)
-    else:
-        alpha = oidImg
-    img.paste(oidImg, (x, y), alpha)
-
-def drawScriptOid(oidName, x, y, size, round=True):
-    drawOid(codes[oidName], x, y, size, round)
-
-# Add title & subtitle
-font = ImageFont.truetype('Courier', int(dpi / 2))
-centerText(width/2, yTitle, title, font, 'black')
-font = ImageFont.truetype('Courier', int(dpi / 8))
-centerText(width/2, ySubtitle, f'Id: {game["product-id"]}, {dpi}dpi, {pixelSize}mm', font, 'lightgray')
-
-# Draw header line
-font = ImageFont.truetype('Courier', int(dpi * 3 / 4))
-color = 'lightgray'
-m = (w - (players + 3) * circleSize) / (players + 2)
-lineWidth = int(dpi/20)
-for c in range(players + 3):
-    x = int(c * (circleSize + m))
-    draw.arc([x, yHeader, x+circleSize+1, circleSize+1+yHeader], start=0, end=360, fill=color, width=int(dpi/60))
-    if c == 0:
-        # Draw start symbol
-        d = circleSize / 5
-        draw.arc([d, d + yHeader, circleSize-d+1, circleSize-d+1 + yHeader], start=-30, end=210, fill=color, width=lineWidth)
-        draw.line([circleSize / 2, circleSize / 4 + yHeader, circleSize / 2, circleSize * 3/5 + yHeader], fill=color, joint="curve", width=lineWidth)
-        drawOid(game['product-id'], x, yHeader, circleSize)
-    elif c <= players:
-        centerText(x + circleSize / 2, circleSize / 2 + yHeader, str(c), font, color)
-        drawScriptOid(f'p{c}', x, yHeader, circleSize)
-    elif c == players + 1:
-        centerText(x + circleSize / 2, circleSize / 2 + yHeader, '?', font, color)
-        drawScriptOid('q', x, yHeader, circleSize)
-    else:
-        # Draw repeat symbol
-        d = circleSize / 5
-        draw.arc([x + d, d + yHeader, x + circleSize-d+1, circleSize-d+1 + yHeader], start=0, end=270, fill=color, width=lineWidth)
-        draw.polygon([(x + circleSize/2, d/2+lineWidth/2 + yHeader), (x + circleSize/2 + d*2/3, d+lineWidth/2 + yHeader), (x + circleSize/2, d*3/2+lineWidth/2 + yHeader)], fill=color)
-        drawScriptOid('r', x, yHeader, circleSize)
-
-# Draw cards
-cardWidth = (w - cols * size - (cols-1) * margin) / 2
-for r in range(rows):
-    for c in range(cols):
-        if c + r * cols < numCards:
-            y = int(r * (size + margin) + yCards)
-            x = int(c * (size + margin) + cardWidth)
-            draw.rectangle([x, y, x+size+1, y+size+1], outline='black', width=20)
-            drawScriptOid(f'c{r * cols + c}', x, y, size, round=False)
-
-# We're done!
-img.save(outputImage, dpi=(dpi, dpi))
+        os.rename(f'./oid-{oid}.png', oidPath(oid))
+
+    # Generate all OID files that are not yet in the cache, running one tttool process per OID in parallel
+    oids = dict.fromkeys([game['product-id']] + [codes[s] for s in [f'p{p}' for p in range(1, players+1)] + ['q', 'r'] + [f'c{c}' for c in range(numCards)]])
+    missingOids = [oid for oid in oids if not os.path.isfile(oidPath(oid))]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(generateOid, missingOids))
+
+    img = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(img)
+
+    def centerText(x, y, msg, font, color):
+        # center the bounding box of the drawn text (which can be offset from the text origin depending on the font)
+        x0, y0, x1, y1 = font.getbbox(msg)
+        draw.text((x-(x0+x1)/2, y-(y0+y1)/2), msg, fill=color, font=font)
+
+    # Round masks by size (shared by all OIDs of the same size)
+    circleMasks = {}
+    # The OIDs are composited onto the board in one pass after everything else is drawn: list of (oid image key, x, y)
+    oidPlacements = []
+
+    def circleMask(size):
+        # boolean array that is True for all pixels inside the circle
+        if not size in circleMasks:
+            r = (size+1) / 2
+            y, x = np.ogrid[:size+1, :size+1]
+            circleMasks[size] = (x + 0.5 - r)**2 + (y + 0.5 - r)**2 <= r**2
+        return circleMasks[size]
+
+    def prepareOid(key):
+        # returns the OID color channels and its alpha channel
+        oid, size, round = key
+        oidImg = np.asarray(Image.open(oidPath(oid)).crop((0, 0, size+1, size+1)).convert("RGBA"))
+        alpha = oidImg[:, :, 3:]
+        if round:
+            # Create a round alpha channel to keep only a circle
+            alpha = np.where(circleMask(size)[:, :, np.newaxis], alpha, 0).astype(np.uint8)
+        return (oidImg[:, :, :3], alpha)
+
+    def drawOid(oid, x, y, size, round=True):
+        oidPlacements.append(((oid, size, round), x, y))
+
+    def blendOid(canvas, x, y, src, alpha):
+        # alpha blend an OID onto the canvas (clipped at the canvas border)
+        region = canvas[y:y+src.shape[0], x:x+src.shape[1]]
+        h, w = region.shape[:2]
+        alpha = alpha[:h, :w].astype(np.uint16)
+        region[:] = (src[:h, :w] * alpha + region * (255 - alpha) + 127) // 255
+
+    def compositeOids(canvas):
+        # Prepare the OID images in parallel (PNG decoding and numpy release the GIL) and blend them one after the other as they get ready
+        # (only a few prepared images are kept at a time)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for key, x, y in oidPlacements:
+                pending.append((executor.submit(prepareOid, key), x, y))
+                if len(pending) > 8:
+                    future, px, py = pending.popleft()
+                    blendOid(canvas, px, py, *future.result())
+            while pending:
+                future, px, py = pending.popleft()
+                blendOid(canvas, px, py, *future.result())
+
+    def drawScriptOid(oidName, x, y, size, round=True):
+        drawOid(codes[oidName], x, y, size, round)
+
+    # Add title & subtitle
+    font = ImageFont.truetype('Courier', int(dpi / 2))
+    centerText(width/2, yTitle, title, font, 'black')
+    font = ImageFont.truetype('Courier', int(dpi / 8))
+    centerText(width/2, ySubtitle, f'Id: {game["product-id"]}, {dpi}dpi, {pixelSize}mm', font, 'lightgray')
+
+    # Draw header line
+    font = ImageFont.truetype('Courier', int(dpi * 3 / 4))
+    color = 'lightgray'
+    m = (w - (players + 3) * circleSize) / (players + 2)
+    lineWidth = int(dpi/20)
+    for c in range(players + 3):
+        x = int(c * (circleSize + m))
+        draw.arc([x, yHeader, x+circleSize+1, circleSize+1+yHeader], start=0, end=360, fill=color, width=int(dpi/60))
+        if c == 0:
+            # Draw start symbol
+            d = circleSize / 5
+            draw.arc([d, d + yHeader, circleSize-d+1, circleSize-d+1 + yHeader], start=-30, end=210, fill=color, width=lineWidth)
+            draw.line([circleSize / 2, circleSize / 4 + yHeader, circleSize / 2, circleSize * 3/5 + yHeader], fill=color, joint="curve", width=lineWidth)
+            drawOid(game['product-id'], x, yHeader, circleSize)
+        elif c <= players:
+            centerText(x + circleSize / 2, circleSize / 2 + yHeader, str(c), font, color)
+            drawScriptOid(f'p{c}', x, yHeader, circleSize)
+        elif c == players + 1:
+            centerText(x + circleSize / 2, circleSize / 2 + yHeader, '?', font, color)
+            drawScriptOid('q', x, yHeader, circleSize)
+        else:
+            # Draw repeat symbol
+            d = circleSize / 5
+            draw.arc([x + d, d + yHeader, x + circleSize-d+1, circleSize-d+1 + yHeader], start=0, end=270, fill=color, width=lineWidth)
+            draw.polygon([(x + circleSize/2, d/2+lineWidth/2 + yHeader), (x + circleSize/2 + d*2/3, d+lineWidth/2 + yHeader), (x + circleSize/2, d*3/2+lineWidth/2 + yHeader)], fill=color)
+            drawScriptOid('r', x, yHeader, circleSize)
+
+    # Draw cards
+    cardWidth = (w - cols * size - (cols-1) * margin) / 2
+    for r in range(rows):
+        for c in range(cols):
+            if c + r * cols < numCards:
+                y = int(r * (size + margin) + yCards)
+                x = int(c * (size + margin) + cardWidth)
+                draw.rectangle([x, y, x+size+1, y+size+1], outline='black', width=20)
+                drawScriptOid(f'c{r * cols + c}', x, y, size, round=False)
+
+    # Add the OIDs, we're done!
+    # (only one copy of the board is kept at a time, it is several hundred MB at 1200 dpi)
+    canvas = np.array(img)
+    del draw, img
+    compositeOids(canvas)
+    img = Image.fromarray(canvas)
+    del canvas
+    # (a low compression level is much faster to save at the cost of a larger file)
+    img.save(outputImage, dpi=(dpi, dpi), compress_level=1)
+except BaseException:
+    # Still report the gme file (or why it could not be assembled) if the game board could not be produced
+    waitForAssemble()
+    raise
+
+if not waitForAssemble():
+    sys.exit(1)
 print(f'Generated file: {outputImage}')